@@ -4,10 +4,18 @@ import sys
 import re
 import sqlite3
 from bs4 import BeautifulSoup
-import urllib.request
+import lxml.html as LH
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import hashlib
+import contextlib
 import time
 import json
+import threading
+import textwrap
+import itertools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 # This program will first download a list of stocks from the TSX. Then, for
 # each stock, it grabs company information, including company name and
@@ -42,54 +50,115 @@ CREATE TABLE FINANCIALS (
 
 """
 
+# Indexes for looking up the financials and prices of a symbol. These are
+# created separately from the tables so that they can be added to databases
+# created by older versions of this program. Any duplicate financials left
+# behind by those versions are removed first, keeping the newest row.
+INDEXES = """
+DELETE FROM FINANCIALS WHERE rowid NOT IN
+    (SELECT MAX(rowid) FROM FINANCIALS GROUP BY symbol, type, date);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_fin_uniq ON FINANCIALS(symbol, type, date);
+
+CREATE INDEX IF NOT EXISTS idx_prices ON PRICES(symbol, date DESC);
+"""
+
 DATABASE_NAME = "pleco.db"
 CACHE_FOLDER = "cache"
 
+# Number of web pages to download at the same time.
+FETCH_THREADS = 16
+
+# Number of seconds to wait for a web server before giving up.
+FETCH_TIMEOUT = 30
+
+# Size of the buffer used to read and write pages in the cache.
+IO_BUFFER_SIZE = 1 << 20
+
+# Regular expressions used while scraping the Google Finance pages.
+COMPANY_NAME_RE = re.compile(r"""Financial Statements for (.*?) - Google Finance""")
+DATE_RE = re.compile(r"""(\d{4}-\d{2}-\d{2})""")
+PERIOD_RE = re.compile(r"""\d+ (months|weeks) ending""")
+
+# Companies in industries matching this expression are left out of the
+# results of --process.
+EXCLUDED_INDUSTRIES_RE = re.compile(r"""Oil|Mining|Metals|Diversified|Forestry""")
+
+# Translation table that removes the thousands separators from numbers.
+NO_COMMAS = str.maketrans( "", "", "," )
+
 class Database:
     def __init__(self):
         create = not os.path.exists( DATABASE_NAME )
 
-        self.conn = sqlite3.connect( DATABASE_NAME, timeout=99.0 )
+        # Transactions are managed explicitly with transaction(), so that
+        # bulk writes can be grouped together instead of committing after
+        # each row.
+        self.conn = sqlite3.connect( DATABASE_NAME, timeout=99.0,
+                isolation_level=None )
+        self.conn.row_factory = sqlite3.Row
+
+        # Use write-ahead logging, which needs fewer fsyncs per transaction
+        # and lets readers run while we are writing. With WAL, synchronous
+        # NORMAL is still safe against corruption.
+        self.conn.execute( "PRAGMA journal_mode=WAL" )
+        self.conn.execute( "PRAGMA synchronous=NORMAL" )
+        self.conn.execute( "PRAGMA temp_store=MEMORY" )
+        self.conn.execute( "PRAGMA cache_size=-65536" ) # 64 MiB
+
+        c = self.conn.cursor()
         if create:
-            c = self.conn.cursor()
             c.executescript( SCHEMA )
 
-    def addCompany( self, symbol, company, industry ):
-        c = self.conn.cursor()
-        c.execute( "DELETE FROM COMPANIES WHERE symbol=?", (symbol,));
-        c.execute( "INSERT INTO COMPANIES values ( ?, ?, ? )", 
-                (symbol, company, industry ) )
+        c.execute( "SELECT name FROM sqlite_master WHERE type='index' AND name='idx_fin_uniq'" )
+        if c.fetchone() is None:
+            c.executescript( INDEXES )
+
+    # Run the body of a with statement in one transaction. It is committed
+    # at the end, or rolled back if an exception is raised.
+    @contextlib.contextmanager
+    def transaction( self ):
+        self.conn.execute( "BEGIN" )
+        try:
+            yield
+        except BaseException:
+            self.conn.rollback()
+            raise
         self.conn.commit()
 
+    # Store many (symbol, company, industry) rows at once in one transaction.
+    def addCompanies( self, rows ):
+        c = self.conn.cursor()
+        with self.transaction():
+            c.executemany( """INSERT INTO COMPANIES values ( ?, ?, ? )
+                    ON CONFLICT(symbol) DO UPDATE SET
+                    company=excluded.company, industry=excluded.industry""", rows )
+
+    # Returns an iterator over all of the companies. Rows are read as they
+    # are needed, so iterate over it once rather than keeping it around.
     def getCompanies(self):
         c = self.conn.cursor()
         c.execute( "SELECT * FROM COMPANIES" )
-        return c.fetchall();
+        return c
 
     def setPrice(self, symbol, date, price):
         c = self.conn.cursor()
         c.execute( "INSERT INTO PRICES VALUES (?, ?, ?)",
                 ( symbol, date, price ) )
-        self.conn.commit()
 
     def getPrice(self, symbol ):
         c = self.conn.cursor()
-        c.execute( "SELECT price FROM PRICES WHERE symbol=? ORDER BY DATE DESC",
+        c.execute( "SELECT price FROM PRICES WHERE symbol=? ORDER BY DATE DESC LIMIT 1",
                 ( symbol, ) )
-        return c.fetchone()[0]
-
-    def getPrice(self, symbol):
-        c = self.conn.cursor()
-        c.execute( "SELECT price FROM PRICES ORDER BY DATE DESC" )
-        return c.fetchone()[0]
+        row = c.fetchone()
+        return row[0] if row else None
 
-    def setFinancials( self, symbol, type, date, value ):
+    # Store many (symbol, type, date, value) rows at once, replacing any
+    # existing values for the same symbol, type and date.
+    def setFinancialsBulk( self, rows ):
         c = self.conn.cursor()
-        c.execute("DELETE FROM FINANCIALS WHERE symbol=? AND type=? and date=?",
-                (symbol, type, date))
-        c.execute("INSERT INTO FINANCIALS VALUES (?, ?, ?, ?)",
-                ( symbol, type, date, value ) )
-        self.conn.commit()
+        with self.transaction():
+            c.executemany("INSERT OR REPLACE INTO FINANCIALS VALUES (?, ?, ?, ?)", rows)
 
     def getFinancials( self, symbol, type ):
         c = self.conn.cursor()
@@ -97,13 +166,27 @@ class Database:
                 (symbol, type))
         return c.fetchall()
 
+    # Returns all of the financials, grouped into a dictionary indexed by
+    # (symbol, type). Each list is sorted by date, newest first.
+    def getAllFinancialsGrouped( self ):
+        c = self.conn.cursor()
+        c.execute( "SELECT * FROM FINANCIALS ORDER BY symbol, type, date DESC" )
+        return { key: list(rows) for key, rows in
+                itertools.groupby( c, key=lambda row: ( row[0], row[1] ) ) }
+
+    # Returns a dictionary of the latest known price of each symbol.
+    def getLatestPrices( self ):
+        c = self.conn.cursor()
+        c.execute( "SELECT symbol, price, MAX(date) FROM PRICES GROUP BY symbol" )
+        return { row[0]: row[1] for row in c }
+
     def getEverything( self ):
         c = self.conn.cursor()
         c.execute( """
-                SELECT COMPANIES.symbol, company, industry, type, value, price from
-                COMPANIES, PRICES, FINANCIALS WHERE
-                COMPANIES.symbol = PRICES.symbol AND PRICES.symbol =
-                FINANCIALS.symbol""")
+                SELECT c.symbol, c.company, c.industry, f.type, f.value,
+                    (SELECT price FROM PRICES p WHERE p.symbol = c.symbol
+                     ORDER BY date DESC LIMIT 1) AS price
+                FROM COMPANIES c JOIN FINANCIALS f ON f.symbol = c.symbol""")
 
         return c.fetchall()
 
@@ -114,27 +197,169 @@ class PageCache:
         if not os.path.exists( CACHE_FOLDER ):
             os.mkdir( CACHE_FOLDER )
 
-    def get( self, url, fname = None ):
+        # Reuse connections to the same host, ask for compressed pages, and
+        # retry requests that fail because of a temporary problem.
+        self.session = requests.Session()
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+        adapter = HTTPAdapter( pool_maxsize=FETCH_THREADS,
+                max_retries=Retry( total=3, backoff_factor=0.5 ) )
+        self.session.mount( "http://", adapter )
+        self.session.mount( "https://", adapter )
+
+    # Download the page into the cache, unless it is already there. Returns
+    # the name of the file in the cache.
+    def fetch( self, url, fname = None ):
         if fname == None:
             fname = hashlib.sha1(url.encode('utf-8')).hexdigest()
         fname = os.path.join( CACHE_FOLDER, fname )
 
-        if os.path.exists( fname ):
-            return open( fname, "rt" ).read()
-        else:
+        if not os.path.exists( fname ):
             print("Retrieve %s" % url)
-            f = urllib.request.urlopen(url)
-            content = f.read().decode('utf-8')
-            f.close()
-
-            f = open( fname, "w" );
-            f.write( content );
-            f.close()
+            r = self.session.get( url, timeout=FETCH_TIMEOUT )
+            r.raise_for_status()
+            data = r.content
+
+            # Write to a temporary file first, and move it into place, so that
+            # a partially written page is never seen by another thread, or
+            # left behind if we crash.
+            tmpname = "%s.tmp.%d.%d" % ( fname, os.getpid(),
+                    threading.get_ident() )
+            try:
+                with open( tmpname, "wb", buffering=IO_BUFFER_SIZE ) as f:
+                    f.write( data )
+                    f.flush()
+                    os.fsync( f.fileno() )
+                os.replace( tmpname, fname )
+            except BaseException:
+                if os.path.exists( tmpname ):
+                    os.remove( tmpname )
+                raise
+
+        return fname
 
-            return content
+    def get( self, url, fname = None ):
+        fname = self.fetch( url, fname )
+        with open( fname, "rb", buffering=IO_BUFFER_SIZE ) as f:
+            return f.read().decode('utf-8')
 
 class EmptyClass: pass
 
+# Returns the URL of the Google Finance page with the financial statements for
+# the given symbol.
+def financialsUrl( symbol ):
+    return "http://www.google.com/finance?q=%s&fstype=ii" % symbol
+
+# Parse the financial information from the quarterly reports of a single
+# company, given the Google Finance page. Returns a list of rows for the
+# FINANCIALS table. This does not touch the database or the network, so that
+# it can run in a separate process.
+def parseFinancials( symbol, page ):
+    def checkPresence( page, pattern ):
+        return page.find(pattern) != -1
+
+    # Find the first td with the given text inside the div with the given
+    # id, and return the values in the td elements that follow it.
+    def extractRow( root, divId, text ):
+        row = root.xpath( "(//div[@id=$id]//td[normalize-space()=$t])[1]"
+                "/following-sibling::td", id=divId, t=text )
+        return moneyToNumber( [ td.text_content().strip() for td in row ] )
+
+    def moneyToNumber( arr ):
+        return [ 0 if a == '-' else int(float(a.translate(NO_COMMAS)) * 1000)
+                for a in arr ]
+
+    def extractDates( lines ):
+        return [ m.group(0) if m else ""
+                for m in map( DATE_RE.search, lines ) ]
+
+    # Return the lines of the page that match the pattern, stopping once
+    # five lines in a row fail to match after the first match.
+    def findLinesLike( page, pattern ):
+        lines = []
+        end = -1
+        for m in pattern.finditer( page ):
+            start = page.rfind( '\n', 0, m.start() ) + 1
+            if start <= end:
+                # another match on the line we already have
+                continue
+            if end >= 0 and page.count( '\n', end, start ) > 5:
+                break
+            end = page.find( '\n', m.end() )
+            if end == -1:
+                end = len(page)
+            lines.append( page[start:end] )
+        return lines
+
+    print("Scraping financials for %s" % symbol)
+
+    # Look for "In Millions of". If not there, error! This is checked before
+    # parsing, so that empty and error pages are never parsed.
+    if not checkPresence( page, "In Millions of" ):
+        print("While processing %s could not find 'In Millions of' at %s" % (symbol, financialsUrl( symbol )), file=sys.stderr)
+        return []
+
+    root = LH.fromstring(page)
+    quarterlyPage = root.xpath( "//div[@id='incinterimdiv']" )
+    annualPage = root.xpath( "//div[@id='incannualdiv']" )
+
+    qstr = "".join( LH.tostring( div, encoding="unicode" )
+            for div in quarterlyPage )
+    astr = "".join( LH.tostring( div, encoding="unicode" )
+            for div in annualPage )
+
+    # Set multiplier to 1000000
+    multiplier = 1000000
+
+    # build array of all lines like "3 months Ending"
+    quarterlyDates = extractDates(findLinesLike( qstr, PERIOD_RE ))
+
+    # Build array of all lines like "12 months Ending"
+    annualDates = extractDates(findLinesLike( astr, PERIOD_RE ))
+
+    # Look for td containing "Total Revenue"
+    # Extract all td elements in siblings that contain only a number
+
+    # Build table for revenue
+    quarterlyRevenue = extractRow( root, "incinterimdiv", "Revenue" )
+    annualRevenue = extractRow( root, "incannualdiv", "Revenue" )
+
+    # Build table for ";Diluted EPS Normalized EPS&"
+    quarterlyEPS = extractRow( root, "incinterimdiv", "Diluted Normalized EPS" )
+    annualEPS = extractRow( root, "incannualdiv", "Diluted Normalized EPS" )
+
+    rows = []
+    for i in range( len(quarterlyRevenue) ):
+        rows.append( ( symbol, "QuarterlyRevenue", quarterlyDates[i],
+                quarterlyRevenue[i] * multiplier ) )
+        rows.append( ( symbol, "QuarterlyEPS", quarterlyDates[i],
+                quarterlyEPS[i] ) )
+
+    for i in range( len(annualRevenue) ):
+        rows.append( ( symbol, "AnnualRevenue", annualDates[i],
+                annualRevenue[i] * multiplier ) )
+        rows.append( ( symbol, "AnnualEPS", annualDates[i],
+                annualEPS[i] ) )
+
+    return rows
+
+# The PageCache of a worker process, created once by startWorker.
+workerCache = None
+
+def startWorker():
+    global workerCache
+    workerCache = PageCache()
+
+# Scrape the financial information of a single company from its page in the
+# cache. This runs in a worker process. Errors are reported and the symbol is
+# skipped, so that one bad page does not lose the financials of the others.
+def scrapeFinancialsForSymbol( symbol ):
+    url = financialsUrl( symbol )
+    try:
+        return parseFinancials( symbol, workerCache.get( url ) )
+    except Exception as e:
+        print("While processing %s could not parse %s: %s" % (symbol, url, e), file=sys.stderr)
+        return []
+
 # The Pleco class contains logic for scraping the stock information from the
 # internet.
 class Pleco:
@@ -152,9 +377,13 @@ class Pleco:
 
         # lookup file, otherwise retrieve the url
         url = f"https://www.theglobeandmail.com/investing/markets/stocks/{symbol}-T/profile/"
-        page = self.webCache.get( url )
+        try:
+            page = self.webCache.get( url )
+        except ( requests.RequestException, UnicodeDecodeError ) as e:
+            print(f"Warning: Cannot retrieve {url}: {e}")
+            return "N/A"
         
-        soup = BeautifulSoup(page, 'html.parser')
+        soup = BeautifulSoup(page, 'lxml')
         industry_element = soup.find('barchart-field', {"name": "industryGroup"})
 
         if industry_element is None:
@@ -166,13 +395,12 @@ class Pleco:
     # This function will, given a stock symbol, scrape the company name from
     # Google Finance. It returns it as a string.
     def scrapeCompanyNameForSymbol( self, symbol ):
-        url = "http://www.google.com/finance?q=%s&fstype=ii" % symbol.upper()
+        url = financialsUrl( symbol.upper() )
         page = self.webCache.get( url )
 
-        expr = re.compile(r"""Financial Statements for (.*?) - Google Finance""")
-        m = expr.search(page)
+        m = COMPANY_NAME_RE.search(page)
         if m:
-            return BeautifulSoup(m.group(1), 'html.parser').contents[0].string
+            return BeautifulSoup(m.group(1), 'lxml').contents[0].string
         else:
             return None
 
@@ -180,7 +408,8 @@ class Pleco:
     # scraped from the TSX web page.
     def scrapeCompanies( self ):
         letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
-        found = {}
+        found = set()
+        pending = []
 
         for s in letters:
             url = f"https://www.tsx.com/json/company-directory/search/tsx/{s}"
@@ -193,17 +422,26 @@ class Pleco:
                     if symbol in found: 
                         continue
                         
-                    found[symbol] = 1
-                    name = company['name']
-                    industry = self.scrapeIndustryForSymbol(symbol)
-                    
-                    if name and industry:
-                        print(f"Found {name} ({symbol}) - {industry}")
-                        self.db.addCompany(symbol, name, industry)
+                    found.add( symbol )
+                    pending.append( ( symbol, company['name'] ) )
                         
             except json.JSONDecodeError as e:
                 print(f"Error parsing JSON for letter {s}: {e}", file=sys.stderr)
 
+        # Look up the industries in parallel, since most of the time is spent
+        # waiting for the web pages.
+        with ThreadPoolExecutor( FETCH_THREADS ) as executor:
+            industries = list( executor.map( self.scrapeIndustryForSymbol,
+                    [ symbol for symbol, name in pending ] ) )
+
+        companies = []
+        for ( symbol, name ), industry in zip( pending, industries ):
+            if name and industry:
+                print(f"Found {name} ({symbol}) - {industry}")
+                companies.append( ( symbol, name, industry ) )
+
+        self.db.addCompanies( companies )
+
     # Assume the database already has the companies table filled in. This
     # function will get the current price of every company that we know about
     # and store it in the prices table, along with the date. 
@@ -212,12 +450,13 @@ class Pleco:
         
         # Given a list of symbols, we get the prices from YAHOO finance and
         # insert them into the PRICES table of the database.
-        def getPrices(stocks, list):
+        def getPrices(list):
             prices = requestYahooPrices( convertToYahooFormat( list ) )
 
-            for i in range(len(prices)):
-                self.db.setPrice( list[i], date, prices[i] )
-                print("%s = $%.2f" % (list[i], float(prices[i]) / 1000))
+            with self.db.transaction():
+                for i in range(len(prices)):
+                    self.db.setPrice( list[i], date, prices[i] )
+                    print("%s = $%.2f" % (list[i], float(prices[i]) / 1000))
 
         # Given a stock symbol which may be in google finance format, we
         # convert them to yahoo format (eg, ending in .to)
@@ -251,155 +490,60 @@ class Pleco:
             # return the list.
             return prices
 
-        stocks = {}
-        date = int(time.time())
-        for company in self.db.getCompanies():
-            stocks[company[0]] = 0
-
-        # for each chunk of 64 stocks,
-        array = []
-        for key in stocks.keys():
-            array.append( key )
-            if len( array ) == 64:
-                getPrices( stocks, array )
-                array = []
+        symbols = ( company[0] for company in self.db.getCompanies() )
 
-        if len( array ) > 0:
-            getPrices( stocks, array )
-            array = []
+        # for each chunk of 64 stocks, stored in its own transaction so that
+        # an error does not lose the prices of the earlier chunks,
+        chunk = list( itertools.islice( symbols, 64 ) )
+        while chunk:
+            getPrices( chunk )
+            chunk = list( itertools.islice( symbols, 64 ) )
 
     # Scrape the financial information from the quarterly reports of all
     # companies and store in the database.
     def scrapeFinancials( self ):
-        for company in self.db.getCompanies():
-            self.scrapeFinancialsForSymbol( company[0] )
-
-    # Scrape the financial information from the quarterly reports of a single
-    # company and store in the database.
-    def scrapeFinancialsForSymbol( self, symbol ):
-        date = int(time.time())
-
-        def checkPresence( page, pattern ):
-            for line in page:
-                if line.find(pattern) != -1:
-                    return True
-
-            return False
-
-        def extractRow( soup, text ):
-            def byname(tag):
-                return str(tag.string).rstrip() == text and tag.name == 'td'
-
-            tag = soup.find(byname)
-            contents = []
-            while tag:
-                tag = tag.findNextSibling('td')
-                if tag == None: break
-                contents.append(str(tag.find(text=True)))
-            return moneyToNumber(contents)
-
-        def moneyToNumber( arr ):
-            ret = []
-            for a in arr:
-                if a == '-':
-                    ret.append(0)
-                else:
-                    ret.append(int(float(a.replace(",", "")) * 1000 ))
-
-            return ret
-
-        def extractDates( lines ):
-            values = []
-            expr = re.compile(r"""(\d{4}-\d{2}-\d{2})""")
-            for line in lines:
-                m = expr.search(line)
-                if m:
-                    values.append( m.group(0) )
-                else:
-                    values.append("")
-
-            return values
-
-        def findLinesLike( page, pattern ):
-            lines = []
-            skipped = -1
-            pattern = re.compile(pattern)
-            for line in page:
-                if pattern.search(line):
-                    lines.append( line )
-                    skipped = 0
-                elif skipped >= 0:
-                    skipped += 1
-                    if skipped >= 5:
-                        break
-            return lines
-
-        print("Scraping financials for %s" % symbol)
-
-        # retrieve the web page
-        url = "http://www.google.com/finance?q=%s&fstype=ii" % symbol
-        page = self.webCache.get( url )
-        soup = BeautifulSoup(page, 'html.parser')
-        page = page.split('\n')
-        quarterlyPage = soup.find( "div", { "id" : "incinterimdiv" } )
-        annualPage = soup.find( "div", { "id" : "incannualdiv" } )
-
-        qstr = str(quarterlyPage).split('\n')
-        astr = str(annualPage).split('\n')
+        symbols = [ company[0] for company in self.db.getCompanies() ]
 
-        # Look for "In Millions of". If not there, error!
-        if not checkPresence( page, "In Millions of" ):
-            print("While processing %s could not find 'In Millions of' at %s" % (symbol, url), file=sys.stderr)
-            return False
-
-        # Set multiplier to 1000000
-        multiplier = 1000000
-
-        # build array of all lines like "3 months Ending"
-        quarterlyDates = extractDates(findLinesLike( qstr, r"""\d+ (months|weeks) ending""" ))
-
-        # Build array of all lines like "12 months Ending"
-        annualDates = extractDates(findLinesLike( astr, r"""\d+ (months|weeks) ending""" ))
-
-        # Look for td containing "Total Revenue"
-        # Extract all td elements in siblings that contain only a number
-
-        # Build table for revenue
-        quarterlyRevenue = extractRow( quarterlyPage, "Revenue" )
-        annualRevenue = extractRow( annualPage, "Revenue" )
-
-        # Build table for ";Diluted EPS Normalized EPS&"
-        quarterlyEPS = extractRow( quarterlyPage, "Diluted Normalized EPS" )
-        annualEPS = extractRow( annualPage, "Diluted Normalized EPS" )
-
-        for i in range( len(quarterlyRevenue) ):
-            self.db.setFinancials( symbol, "QuarterlyRevenue", quarterlyDates[i],
-                    quarterlyRevenue[i] * multiplier )
-            self.db.setFinancials( symbol, "QuarterlyEPS", quarterlyDates[i],
-                    quarterlyEPS[i] )
-
-        for i in range( len(annualRevenue) ):
-            self.db.setFinancials( symbol, "AnnualRevenue", annualDates[i],
-                    annualRevenue[i] * multiplier )
-            self.db.setFinancials( symbol, "AnnualEPS", annualDates[i],
-                    annualEPS[i] )
-
-    def addProjected( self, symbol, type ):
-        financials = self.db.getFinancials( symbol, "Quarterly%s" % type )
-        if len(financials) < 4:
-            return
-
-        projected = financials[0][3] + financials[1][3] + financials[2][3] + \
-                    financials[3][3]
+        # Download a page into the cache if it is not there yet. Returns
+        # False if it could not be downloaded.
+        def fetch( symbol ):
+            url = financialsUrl( symbol )
+            try:
+                self.webCache.fetch( url )
+                return True
+            except requests.RequestException as e:
+                print("While processing %s could not retrieve %s: %s" % (symbol, url, e), file=sys.stderr)
+                return False
+
+        # Download any pages that are not in the cache yet in parallel first.
+        # Symbols whose page could not be downloaded are skipped.
+        with ThreadPoolExecutor( FETCH_THREADS ) as executor:
+            fetched = list( executor.map( fetch, symbols ) )
+        symbols = [ symbol for symbol, ok in zip( symbols, fetched ) if ok ]
+
+        # Parsing the pages is CPU bound, so spread it over several processes.
+        # Only this process writes to the database.
+        rows = []
+        with ProcessPoolExecutor( initializer=startWorker ) as executor:
+            for result in executor.map( scrapeFinancialsForSymbol, symbols,
+                    chunksize=16 ):
+                rows.extend( result )
+
+        self.db.setFinancialsBulk( rows )
+
+    # Given the quarterly financials of a company, newest first, returns the
+    # total of the last four quarters, or None if there are not enough.
+    def computeProjected( self, quarterly ):
+        if len(quarterly) < 4:
+            return None
 
-        self.db.setFinancials( symbol, "Projected%s" % type, 0, projected )
+        return quarterly[0][3] + quarterly[1][3] + quarterly[2][3] + \
+               quarterly[3][3]
 
-    def addAverageGrowth( self, symbol, type ):
-        financials = self.db.getFinancials( symbol, "Annual%s" % type )
+    def computeAverageGrowth( self, annual, projected ):
         avgGrowth = 0.0
-        if len(financials) > 1:
-            projected = self.db.getFinancials( symbol, "Projected%s" % type )
-            financials.extend( projected )
+        if len(annual) > 1:
+            financials = annual + projected
             financials.reverse()
             first = financials[0][3]
             count = 0
@@ -418,70 +562,94 @@ class Pleco:
             else:
                 avgGrowth /= count
         
-        self.db.setFinancials( symbol, "Average%sGrowth" % type, 0, 
-                round( avgGrowth * 100 ) )
+        return round( avgGrowth * 100 )
 
-    def addYearsOfGrowth( self, symbol, type ):
-        financials = self.db.getFinancials( symbol, "Annual%s" % type )
+    def computeYearsOfGrowth( self, annual ):
         count = 0
-        if len(financials) > 0:
-            last = financials[0]
-            for line in financials[1:]:
+        if len(annual) > 0:
+            last = annual[0][3]
+            for line in annual[1:]:
                 if line[3] < last:
                     count += 1
                 else:
                     break
 
-        self.db.setFinancials( symbol, "YearsOf%sGrowth" % type, 0, count )
+        return count
 
-    def addPE( self, symbol ):
-        price = self.db.getPrice( symbol )
-        financials = self.db.getFinancials( symbol, "ProjectedEPS" )
-        if len(financials) == 0:
-            return
+    # Returns the P/E ratio times 10, or None if the price or projected
+    # earnings are not known.
+    def computePE( self, price, projectedEPS ):
+        if price is None or len(projectedEPS) == 0:
+            return None
 
-        earnings = financials[0][3]
+        earnings = projectedEPS[0][3]
         if earnings > 0:
-            pe = round(float(price)/float(earnings) * 10)
+            return round(float(price)/float(earnings) * 10)
         else:
-            pe = 0
-
-        self.db.setFinancials( symbol, "PE", 0, pe );
+            return 0
 
     def addExtraInfo( self ):
+        # Read everything that we need up front, rather than querying the
+        # database several times for each company.
+        financials = self.db.getAllFinancialsGrouped()
+        prices = self.db.getLatestPrices()
+        rows = []
+
+        # Record a computed value. It is also put in the financials, since
+        # some of the values are computed from the others.
+        def add( symbol, type, value ):
+            if value is None:
+                return
+            row = ( symbol, type, 0, value )
+            financials[(symbol, type)] = [row]
+            rows.append( row )
+
+        def get( symbol, type ):
+            return financials.get( (symbol, type), [] )
+
         for company in self.db.getCompanies():
             symbol = company[0]
             print("Processing %s...    \r" % symbol, end='')
             sys.stdout.flush()
-            self.addProjected(symbol, "EPS")
-            self.addProjected(symbol, "Revenue")
-            self.addAverageGrowth( symbol, "EPS" )
-            self.addAverageGrowth( symbol, "Revenue" )
-            self.addYearsOfGrowth( symbol, "EPS" )
-            self.addYearsOfGrowth( symbol, "Revenue" )
-            self.addPE( symbol )
+            for type in ( "EPS", "Revenue" ):
+                add( symbol, "Projected%s" % type,
+                        self.computeProjected( get( symbol, "Quarterly%s" % type ) ) )
+            for type in ( "EPS", "Revenue" ):
+                add( symbol, "Average%sGrowth" % type,
+                        self.computeAverageGrowth( get( symbol, "Annual%s" % type ),
+                            get( symbol, "Projected%s" % type ) ) )
+            for type in ( "EPS", "Revenue" ):
+                add( symbol, "YearsOf%sGrowth" % type,
+                        self.computeYearsOfGrowth( get( symbol, "Annual%s" % type ) ) )
+            add( symbol, "PE", self.computePE( prices.get( symbol ),
+                    get( symbol, "ProjectedEPS" ) ) )
 
         print()
+        self.db.setFinancialsBulk( rows )
 
+    # Print all of the companies as a JSON list. Each company is written as
+    # soon as it is read, so the whole list is never held in memory.
     def dump(self):
-        companies = []
+        first = True
         for company in self.db.getCompanies():
-            companies.append({
+            sys.stdout.write( "[\n" if first else ",\n" )
+            sys.stdout.write( textwrap.indent( json.dumps({
                 "symbol": company[0],
                 "name": company[1],
                 "industry": company[2]
-            })
-        print(json.dumps(companies, indent=2))
+            }, indent=2), "  " ) )
+            first = False
+        sys.stdout.write( "[]\n" if first else "\n]\n" )
 
     def process(self):
         stocks = {}
         for record in self.db.getEverything():
-            symbol = record[0]
-            company = record[1]
-            industry = record[2]
-            type = record[3]
-            value = record[4]
-            price = record[5]
+            symbol = record["symbol"]
+            company = record["company"]
+            industry = record["industry"]
+            type = record["type"]
+            value = record["value"]
+            price = record["price"]
             if symbol not in stocks:
                 stock = { "symbol": symbol, 
                     "price": price, 
@@ -493,26 +661,21 @@ class Pleco:
 
             stock[type] = value
 
-        stocks = filter( self.filt, stocks.values() )
-
-        stocks.sort( key = lambda stock: stock["AverageRevenueGrowth"] )
+        stocks = sorted( ( stock for stock in stocks.values() if self.filt(stock) ),
+                key = lambda stock: stock["AverageRevenueGrowth"] )
         self.printTable(stocks)
 
     def filt(self, stock):
         return \
-            stock["YearsOfRevenueGrowth"] >= 1 and \
-            stock["YearsOfEPSGrowth"] >= 1 and \
-            stock["AverageRevenueGrowth"] >= 5 and \
-            stock["AverageEPSGrowth"] >= 5 and \
+            stock.get("YearsOfRevenueGrowth", 0) >= 1 and \
+            stock.get("YearsOfEPSGrowth", 0) >= 1 and \
+            stock.get("AverageRevenueGrowth", 0) >= 5 and \
+            stock.get("AverageEPSGrowth", 0) >= 5 and \
             "PE" in stock and \
             stock["PE"] >= 0 and \
             stock["PE"] <= 50 \
-            and stock["ProjectedEPS"] > 0 \
-            and stock["industry"].find("Oil") == -1 \
-            and stock["industry"].find("Mining") == -1 \
-            and stock["industry"].find("Metals") == -1 \
-            and stock["industry"].find("Diversified") == -1 \
-            and stock["industry"].find("Forestry") == -1 
+            and stock.get("ProjectedEPS", 0) > 0 \
+            and not EXCLUDED_INDUSTRIES_RE.search( stock["industry"] )
 
     def printTable(self, stocks):
         print("symbol, AverageRevenueGrowth, YearsOfRevenueGrowth, AverageEPSGrowth, YearsOfEPSGrowth, PE, Company")
@@ -541,12 +704,15 @@ class Pleco:
                 self.scrapePrices()
                 self.addExtraInfo()
             elif sys.argv[i] == "--test": 
-                self.addPE("tse:g")
+                pe = self.computePE( self.db.getPrice("tse:g"),
+                        self.db.getFinancials("tse:g", "ProjectedEPS") )
+                if pe is not None:
+                    self.db.setFinancialsBulk( [ ( "tse:g", "PE", 0, pe ) ] )
             elif sys.argv[i] == "--process":
                 self.process()
             elif sys.argv[i] == "--dump":
                 self.dump()
 
 
-Pleco().run()
-
+if __name__ == "__main__":
+    Pleco().run()